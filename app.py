@@ -1,19 +1,65 @@
+import asyncio
+import hashlib
 import os
-from typing import Any, Dict, List
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Tuple
 
-from fastapi import FastAPI, Query, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+import orjson
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, Query, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from httpx import HTTPError
+from redis.exceptions import RedisError
 
-from ml_client import MercadoLivreClient, MercadoLivreError
+from ml_client import (
+    MercadoLivreClient,
+    MercadoLivreError,
+    create_http_client,
+    create_redis_client,
+    is_transient_warning,
+)
+from normalize import normalize_items
 
 MAX_LIMIT = int(os.getenv("MAX_LIMIT", "50"))
-
-app = FastAPI(title="API Mercado Livre - Search + Reviews")
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "60"))
+SEARCH_CACHE_SIZE = 1024
+REDIS_SEARCH_TTL = 60
+
+# Cache em memória (por processo) de /search, chave: (query normalizada, limit)
+_search_cache: "TTLCache[Tuple[str, int], asyncio.Task[Dict[str, Any]]]" = TTLCache(
+    maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Um único AsyncClient por processo: reaproveita o pool de conexões (TCP+TLS)
+    app.state.http = create_http_client()
+    # Cache compartilhado entre workers (None quando REDIS_URL não está definido)
+    app.state.redis = create_redis_client()
+    # Cliente único por processo (evita reler env vars a cada requisição)
+    app.state.ml_client = MercadoLivreClient(app.state.http, app.state.redis)
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+
+
+app = FastAPI(
+    title="API Mercado Livre - Search + Reviews",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 templates = Jinja2Templates(directory="templates")
 
 
+def get_ml_client(request: Request) -> MercadoLivreClient:
+    return request.app.state.ml_client
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request) -> HTMLResponse:
     return templates.TemplateResponse("index.html", {"request": request})
@@ -24,53 +70,17 @@ async def health() -> Dict[str, str]:
     return {"status": "ok"}
 
 
-def _normalize_items(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """
-    Garante o contrato mínimo por item:
-      - title
-      - price
-      - image (URL ou None)
-      - permalink
-      - reviews (lista; pode ser vazia)
-    """
-    normalized: List[Dict[str, Any]] = []
-
-    for it in items or []:
-        title = it.get("title") or it.get("name") or ""
-        price = it.get("price")
-        permalink = it.get("permalink") or it.get("url") or None
-
-        # Garante que image seja URL (não thumbnail_id)
-        image = it.get("secure_thumbnail") or it.get("thumbnail") or it.get("image")
-        if image and isinstance(image, str) and image.startswith(("http://", "https://")):
-            image_url = image
-        else:
-            image_url = None
-
-        reviews = it.get("reviews")
-        if not isinstance(reviews, list):
-            reviews = []
-
-        normalized.append(
-            {
-                "id": it.get("id"),
-                "title": title,
-                "price": price,
-                "image": image_url,
-                "permalink": permalink,
-                "reviews": reviews,
-            }
-        )
-
-    return normalized
+def _describe_error(exc: Exception) -> str:
+    if isinstance(exc, MercadoLivreError):
+        return f"Erro ao buscar itens no Mercado Livre ({exc.status_code}): {exc.message}"
+    if isinstance(exc, HTTPError):
+        return f"Erro de rede ao chamar Mercado Livre: {str(exc)}"
+    return f"Erro inesperado no servidor: {str(exc)}"
 
 
-@app.get("/search")
-async def search(
-    query: str = Query(..., min_length=1, description="Termo pesquisado"),
-    limit: int = Query(10, gt=0, le=MAX_LIMIT, description="Máximo de itens retornados"),
-) -> JSONResponse:
-    client = MercadoLivreClient()
+async def _build_search_payload(
+    client: MercadoLivreClient, query: str, limit: int
+) -> Dict[str, Any]:
     warnings: List[str] = []
 
     # Payload base (sempre devolvido, mesmo com falhas externas)
@@ -90,7 +100,7 @@ async def search(
         items_with_reviews, review_warnings = await client.attach_reviews(items)
 
         # Normaliza contrato final
-        normalized = _normalize_items(items_with_reviews)
+        normalized = normalize_items(items_with_reviews)
 
         payload["items"] = normalized
         payload["count"] = len(normalized)
@@ -98,18 +108,132 @@ async def search(
         if review_warnings:
             warnings.extend(review_warnings)
 
-    except MercadoLivreError as exc:
-        # Importante: não quebrar o contrato nem retornar 4xx/5xx
-        warnings.append(
-            f"Erro ao buscar itens no Mercado Livre ({exc.status_code}): {exc.message}"
-        )
-    except HTTPError as exc:
-        warnings.append(f"Erro de rede ao chamar Mercado Livre: {str(exc)}")
     except Exception as exc:
-        warnings.append(f"Erro inesperado no servidor: {str(exc)}")
+        # Importante: não quebrar o contrato nem retornar 4xx/5xx
+        warnings.append(_describe_error(exc))
 
     if warnings:
         payload["warnings"] = warnings
 
-    return JSONResponse(payload)
+    return payload
+
+
+def _is_cacheable(payload: Dict[str, Any]) -> bool:
+    # Só falhas passageiras impedem o cache; 401/403 nas reviews se repetiriam igual
+    return not any(is_transient_warning(w) for w in payload["warnings"])
+
+
+def _search_cache_key(site_id: str, query: str, limit: int) -> str:
+    digest = hashlib.sha1(query.encode("utf-8")).hexdigest()
+    return f"ml:search:{site_id}:{digest}:{limit}"
+
+
+async def _cached_search_payload(
+    client: MercadoLivreClient, query: str, limit: int
+) -> Dict[str, Any]:
+    # Redis é só otimização: qualquer falha nele cai para a busca normal
+    redis = client.redis
+    if redis is None:
+        return await _build_search_payload(client, query, limit)
+
+    key = _search_cache_key(client.site_id, query.lower().strip(), limit)
+    try:
+        cached = await redis.get(key)
+    except RedisError:
+        cached = None
+    if cached is not None:
+        try:
+            return orjson.loads(cached)
+        except orjson.JSONDecodeError:
+            pass  # valor ilegível no Redis = cache miss
+
+    payload = await _build_search_payload(client, query, limit)
+    if _is_cacheable(payload):
+        try:
+            await redis.set(key, orjson.dumps(payload), ex=REDIS_SEARCH_TTL)
+        except RedisError:
+            pass
+
+    return payload
 
+
+def _evict_failed_search(key: Tuple[str, int], task: "asyncio.Task[Dict[str, Any]]") -> None:
+    # Respostas com falhas passageiras não ficam em cache
+    if task.cancelled() or task.exception() is not None or not _is_cacheable(task.result()):
+        if _search_cache.get(key) is task:
+            _search_cache.pop(key, None)
+
+
+@app.get("/search")
+async def search(
+    query: str = Query(..., min_length=1, description="Termo pesquisado"),
+    limit: int = Query(10, gt=0, le=MAX_LIMIT, description="Máximo de itens retornados"),
+    client: MercadoLivreClient = Depends(get_ml_client),
+) -> ORJSONResponse:
+    key = (query.lower().strip(), limit)
+
+    # O cache guarda a Task da busca: requisições concorrentes para a mesma chave
+    # aguardam a mesma chamada ao Mercado Livre (evita stampede).
+    # Sem lock: não há await entre o get e o set, então o bloco é atômico no event loop.
+    task = _search_cache.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_cached_search_payload(client, query, limit))
+        task.add_done_callback(lambda t: _evict_failed_search(key, t))
+        _search_cache[key] = task
+
+    # shield: se este cliente desconectar, a busca continua para os demais
+    payload = await asyncio.shield(task)
+    if payload["query"] != query:
+        payload = {**payload, "query": query}
+
+    return ORJSONResponse(payload)
+
+
+async def _stream_search_lines(
+    client: MercadoLivreClient, query: str, limit: int
+) -> AsyncIterator[bytes]:
+    # NDJSON: uma linha "meta", uma linha "item" por item (assim que suas reviews
+    # ficam prontas) e uma linha final "done" com count e warnings
+    yield orjson.dumps({"type": "meta", "query": query, "limit": limit}) + b"\n"
+
+    warnings: List[str] = []
+    count = 0
+
+    try:
+        items = await client.search_items(query=query, limit=limit)
+
+        items_by_id: Dict[str, List[Dict[str, Any]]] = {}
+        for item in items:
+            item_id = item.get("id")
+            if item_id:
+                items_by_id.setdefault(str(item_id), []).append(item)
+            else:
+                count += 1
+                item["reviews"] = []
+                (normalized,) = normalize_items([item])
+                yield orjson.dumps({"type": "item", "item": normalized}) + b"\n"
+
+        async for item_id, reviews, warning in client.iter_reviews(list(items_by_id)):
+            for item in items_by_id[item_id]:
+                count += 1
+                item["reviews"] = reviews or []
+                (normalized,) = normalize_items([item])
+                yield orjson.dumps({"type": "item", "item": normalized}) + b"\n"
+                if warning:
+                    warnings.append(warning)
+
+    except Exception as exc:
+        warnings.append(_describe_error(exc))
+
+    yield orjson.dumps({"type": "done", "count": count, "warnings": warnings}) + b"\n"
+
+
+@app.get("/search/stream")
+async def search_stream(
+    query: str = Query(..., min_length=1, description="Termo pesquisado"),
+    limit: int = Query(10, gt=0, le=MAX_LIMIT, description="Máximo de itens retornados"),
+    client: MercadoLivreClient = Depends(get_ml_client),
+) -> StreamingResponse:
+    return StreamingResponse(
+        _stream_search_lines(client, query, limit), media_type="application/x-ndjson"
+    )
@@ -2,14 +2,38 @@ import asyncio
 import os
 import random
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 
 import httpx
+import orjson
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
 DEFAULT_TIMEOUT = 12.0
 MAX_RETRIES = 3
 RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
-REVIEWS_CONCURRENCY = 8
+REVIEWS_CONCURRENCY = 50
+# Teto do processo inteiro (entre buscas); maior que o de uma busca para que
+# uma busca com limit=50 sozinha não esgote as permissões
+REVIEWS_PROCESS_CONCURRENCY = 200
+REVIEWS_TIMEOUT = 5.0
+# Orçamento por review: connect (0.5s) + read (1.0s) por tentativa, 1 retry com
+# backoff (<= 0.95s) -> ~3.95s < REVIEWS_TIMEOUT. A espera pelo semáforo e leituras
+# lentas em vários chunks não entram na conta: o prazo de REVIEWS_TIMEOUT cobre esses casos.
+REVIEWS_MAX_RETRIES = 1
+REVIEWS_REQUEST_TIMEOUT = httpx.Timeout(1.0, connect=0.5, pool=0.5)
+MAX_CONNECTIONS = 1000
+MAX_KEEPALIVE_CONNECTIONS = 100
+REVIEWS_CACHE_TTL = 300
+REVIEWS_CACHE_SIZE = 4096
+REDIS_REVIEWS_TTL = 600
+REDIS_TIMEOUT = 0.5
+
+# Cache em memória (por processo) das reviews bem-sucedidas, chave: item_id
+_reviews_cache: "TTLCache[str, List[Dict[str, Any]]]" = TTLCache(
+    maxsize=REVIEWS_CACHE_SIZE, ttl=REVIEWS_CACHE_TTL
+)
 
 
 @dataclass
@@ -24,6 +48,77 @@ def _backoff_seconds(attempt: int) -> float:
     return base + random.uniform(0, 0.35)
 
 
+# 401/403 nas reviews é o resultado normal em hosts de datacenter (não é falha passageira)
+FORBIDDEN_REVIEWS_WARNING = "forbidden_or_unauthorized"
+
+
+def is_transient_warning(warning: str) -> bool:
+    """Warnings passageiros (429, 5xx, rede, timeout) impedem o cache da resposta."""
+    return not warning.startswith(FORBIDDEN_REVIEWS_WARNING)
+
+
+def _reviews_cache_key(item_id: str) -> str:
+    return f"ml:reviews:{item_id}"
+
+
+def create_redis_client() -> Optional[Redis]:
+    """
+    Cache compartilhado entre workers/instâncias. REDIS_URL é opcional:
+    sem ele, fica apenas o cache em memória de cada processo.
+    """
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        return None
+    # Timeouts curtos: Redis lento/inacessível vira RedisError (cache miss) sem travar o /search
+    return Redis.from_url(
+        redis_url, socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT
+    )
+
+
+def _default_headers() -> Dict[str, str]:
+    # Headers estilo navegador para reduzir 403 em cloud/Render
+    headers: Dict[str, str] = {
+        "Accept": "application/json, text/plain, */*",
+        "Accept-Language": "pt-BR,pt;q=0.9,en;q=0.8",
+        "User-Agent": (
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/122.0.0.0 Safari/537.36"
+        ),
+        "Referer": "https://www.mercadolivre.com.br/",
+        "Origin": "https://www.mercadolivre.com.br",
+    }
+    access_token = os.getenv("ML_ACCESS_TOKEN")  # opcional
+    if access_token:
+        headers["Authorization"] = f"Bearer {access_token}"
+    return headers
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Cria o httpx.AsyncClient compartilhado (um por processo), reaproveitando
+    conexões TCP/TLS com api.mercadolibre.com entre requisições.
+    HTTP/2 (requer httpx[http2]) multiplexa o fan-out de reviews numa única conexão.
+    httpx >= 0.27 usa 'proxy' (singular); PROXY_URL é opcional.
+    Headers fixos ficam no próprio client; o httpx os aplica em cada requisição.
+    """
+    kwargs: Dict[str, Any] = {}
+    proxy_url = os.getenv("PROXY_URL")
+    if proxy_url:
+        kwargs["proxy"] = proxy_url
+
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(DEFAULT_TIMEOUT),
+        headers=_default_headers(),
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        **kwargs,
+    )
+
+
 class MercadoLivreClient:
     """
     Cliente ML com:
@@ -33,67 +128,38 @@ class MercadoLivreClient:
     - reviews nunca quebram a resposta final
     """
 
-    def __init__(self) -> None:
+    def __init__(self, client: httpx.AsyncClient, redis: Optional[Redis] = None) -> None:
+        self.client = client
+        self.redis = redis
         self.site_id = os.getenv("ML_SITE_ID", "MLB")
-        self.access_token = os.getenv("ML_ACCESS_TOKEN")  # opcional
         self.proxy_url = os.getenv("PROXY_URL")  # opcional
         self.base_url = "https://api.mercadolibre.com"
-        self.semaphore = asyncio.Semaphore(REVIEWS_CONCURRENCY)
-
-    def _client_kwargs(self) -> Dict[str, Any]:
-        """
-        httpx >= 0.27 usa 'proxy' (singular).
-        Se PROXY_URL não existir, retorna {}.
-        """
-        kwargs: Dict[str, Any] = {}
-        if self.proxy_url:
-            kwargs["proxy"] = self.proxy_url
-        return kwargs
-
-    def _default_headers(self) -> Dict[str, str]:
-        # Headers estilo navegador para reduzir 403 em cloud/Render
-        headers: Dict[str, str] = {
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "pt-BR,pt;q=0.9,en;q=0.8",
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/122.0.0.0 Safari/537.36"
-            ),
-            "Referer": "https://www.mercadolivre.com.br/",
-            "Origin": "https://www.mercadolivre.com.br",
-            "Connection": "keep-alive",
-        }
-        if self.access_token:
-            headers["Authorization"] = f"Bearer {self.access_token}"
-        return headers
+        # URLs montadas uma vez (httpx.URL já parseada) em vez de a cada chamada
+        self.search_url = httpx.URL(f"{self.base_url}/sites/{self.site_id}/search")
+        self.reviews_url_prefix = self.base_url + "/reviews/item/"
+        # Cliente é singleton (app.state): o semáforo limita as reviews do processo inteiro
+        self.semaphore = asyncio.Semaphore(REVIEWS_PROCESS_CONCURRENCY)
 
     async def _request(
         self,
-        client: httpx.AsyncClient,
         method: str,
-        url: str,
+        url: Union[str, httpx.URL],
         params: Optional[Dict[str, Any]] = None,
-        headers: Optional[Dict[str, str]] = None,
-        timeout: float = DEFAULT_TIMEOUT,
+        timeout: Union[float, httpx.Timeout] = DEFAULT_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
     ) -> httpx.Response:
-        merged_headers = self._default_headers()
-        if headers:
-            merged_headers.update(headers)
-
-        for attempt in range(MAX_RETRIES + 1):
+        for attempt in range(max_retries + 1):
             try:
-                resp = await client.request(
+                resp = await self.client.request(
                     method=method,
                     url=url,
                     params=params,
-                    headers=merged_headers,
                     timeout=timeout,
                 )
 
                 # retry em rate limit / 5xx
                 if resp.status_code in RETRY_STATUS_CODES:
-                    if attempt == MAX_RETRIES:
+                    if attempt == max_retries:
                         return resp
                     await asyncio.sleep(_backoff_seconds(attempt))
                     continue
@@ -101,116 +167,260 @@ class MercadoLivreClient:
                 return resp
 
             except (httpx.TimeoutException, httpx.NetworkError) as exc:
-                if attempt == MAX_RETRIES:
+                if attempt == max_retries:
                     raise exc
                 await asyncio.sleep(_backoff_seconds(attempt))
 
         # fallback (não deve chegar)
-        return await client.request(
-            method=method, url=url, params=params, headers=merged_headers, timeout=timeout
+        return await self.client.request(
+            method=method, url=url, params=params, timeout=timeout
         )
 
     async def search_items(self, query: str, limit: int) -> List[Dict[str, Any]]:
-        url = f"{self.base_url}/sites/{self.site_id}/search"
-
-        async with httpx.AsyncClient(**self._client_kwargs()) as client:
-            resp = await self._request(
-                client,
-                "GET",
-                url,
-                params={"q": query, "limit": limit},
-            )
-
-            if resp.status_code != 200:
-                # Dica para o usuário quando for o caso típico de Render sem proxy bom
-                if resp.status_code == 403 and not self.proxy_url:
-                    raise MercadoLivreError(
-                        status_code=403,
-                        message=(
-                            "403 forbidden do Mercado Livre. Isso costuma ser bloqueio de IP/datacenter "
-                            "(ex.: Render). Solução: configurar PROXY_URL no Render (proxy HTTP/HTTPS) "
-                            "ou rodar em outro host/IP."
-                        ),
-                    )
+        resp = await self._request(
+            "GET",
+            self.search_url,
+            params={"q": query, "limit": limit},
+        )
 
+        if resp.status_code != 200:
+            # Dica para o usuário quando for o caso típico de Render sem proxy bom
+            if resp.status_code == 403 and not self.proxy_url:
                 raise MercadoLivreError(
-                    status_code=resp.status_code,
-                    message=f"Erro ao buscar itens: {resp.text}",
+                    status_code=403,
+                    message=(
+                        "403 forbidden do Mercado Livre. Isso costuma ser bloqueio de IP/datacenter "
+                        "(ex.: Render). Solução: configurar PROXY_URL no Render (proxy HTTP/HTTPS) "
+                        "ou rodar em outro host/IP."
+                    ),
                 )
 
-            data = resp.json() or {}
-            results = data.get("results", []) or []
-
-            items: List[Dict[str, Any]] = []
-            for item in results[:limit]:
-                # thumbnail_id às vezes vem, mas nem sempre é URL.
-                # Mantemos compatível: se não vier URL, front lida (ou você pode montar URL depois).
-                items.append(
-                    {
-                        "id": item.get("id"),
-                        "title": item.get("title"),
-                        "price": item.get("price"),
-                        "image": (
-                            item.get("thumbnail")
-                            or item.get("secure_thumbnail")
-                            or item.get("thumbnail_id")
-                        ),
-                    }
-                )
+            raise MercadoLivreError(
+                status_code=resp.status_code,
+                message=f"Erro ao buscar itens: {resp.text}",
+            )
 
-            return items
+        data = orjson.loads(resp.content) or {}
+        results = data.get("results", []) or []
+
+        items: List[Dict[str, Any]] = []
+        for item in results[:limit]:
+            # thumbnail_id às vezes vem, mas nem sempre é URL.
+            # Mantemos compatível: se não vier URL, front lida (ou você pode montar URL depois).
+            items.append(
+                {
+                    "id": item.get("id"),
+                    "title": item.get("title"),
+                    "price": item.get("price"),
+                    "image": (
+                        item.get("thumbnail")
+                        or item.get("secure_thumbnail")
+                        or item.get("thumbnail_id")
+                    ),
+                }
+            )
+
+        return items
 
     async def get_item_reviews(self, item_id: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
         """
         Sempre retorna (lista_reviews, warning). Nunca quebra a API final.
         Regra: 401/403/404/429/timeouts -> reviews=[]
+        Apenas respostas sem warning (200/404) entram no cache.
         """
-        url = f"{self.base_url}/reviews/item/{item_id}"
+        cached = _reviews_cache.get(item_id)
+        if cached is not None:
+            return cached, None
+        return await self._fetch_item_reviews(item_id)
+
+    async def _fetch_item_reviews(
+        self, item_id: str
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        # Sempre vai ao Mercado Livre (sem consultar o cache em memória)
+        try:
+            resp = await self._request(
+                "GET",
+                self.reviews_url_prefix + item_id,
+                timeout=REVIEWS_REQUEST_TIMEOUT,
+                max_retries=REVIEWS_MAX_RETRIES,
+            )
+        except (httpx.TimeoutException, httpx.NetworkError) as exc:
+            return [], f"network_error ao buscar reviews ({item_id}): {exc}"
 
-        async with httpx.AsyncClient(**self._client_kwargs()) as client:
-            try:
-                resp = await self._request(client, "GET", url)
-            except (httpx.TimeoutException, httpx.NetworkError) as exc:
-                return [], f"network_error ao buscar reviews ({item_id}): {exc}"
-
-            if resp.status_code in (401, 403):
-                return [], f"forbidden_or_unauthorized ({resp.status_code}) ao buscar reviews ({item_id})"
-            if resp.status_code == 404:
-                return [], None
-            if resp.status_code == 429:
-                return [], f"rate_limited (429) ao buscar reviews ({item_id})"
-            if resp.status_code != 200:
-                return [], f"erro ({resp.status_code}) ao buscar reviews ({item_id})"
-
-            data = resp.json() or {}
-            reviews = data.get("reviews", []) or []
-            if isinstance(reviews, list):
-                return reviews, None
+        if resp.status_code in (401, 403):
+            return [], f"{FORBIDDEN_REVIEWS_WARNING} ({resp.status_code}) ao buscar reviews ({item_id})"
+        if resp.status_code == 404:
+            _reviews_cache[item_id] = []
             return [], None
+        if resp.status_code == 429:
+            return [], f"rate_limited (429) ao buscar reviews ({item_id})"
+        if resp.status_code != 200:
+            return [], f"erro ({resp.status_code}) ao buscar reviews ({item_id})"
+
+        data = orjson.loads(resp.content) or {}
+        reviews = data.get("reviews", []) or []
+        if not isinstance(reviews, list):
+            reviews = []
+        _reviews_cache[item_id] = reviews
+        return reviews, None
+
+    async def _get_cached_reviews(self, item_ids: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        # Um único MGET no Redis para todos os itens; falha no Redis = cache miss
+        if self.redis is None or not item_ids:
+            return {}
+
+        try:
+            values = await self.redis.mget([_reviews_cache_key(i) for i in item_ids])
+        except RedisError:
+            return {}
+
+        cached: Dict[str, List[Dict[str, Any]]] = {}
+        for item_id, value in zip(item_ids, values):
+            if value is None:
+                continue
+            try:
+                cached[item_id] = orjson.loads(value)
+            except orjson.JSONDecodeError:
+                continue  # valor ilegível = miss só deste item
+        return cached
+
+    async def _store_cached_reviews(self, reviews_by_id: Dict[str, List[Dict[str, Any]]]) -> None:
+        if self.redis is None or not reviews_by_id:
+            return
+
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for item_id, reviews in reviews_by_id.items():
+                    pipe.set(
+                        _reviews_cache_key(item_id), orjson.dumps(reviews), ex=REDIS_REVIEWS_TTL
+                    )
+                await pipe.execute()
+        except RedisError:
+            pass
 
-    async def _fetch_reviews_with_semaphore(
-        self, item: Dict[str, Any]
-    ) -> Tuple[Dict[str, Any], Optional[str]]:
-        async with self.semaphore:
-            item_id = item.get("id")
-            if not item_id:
-                return {**item, "reviews": []}, None
-
-            reviews, warning = await self.get_item_reviews(str(item_id))
-            return {**item, "reviews": reviews or []}, warning
+    async def _reviews_worker(
+        self,
+        queue: "asyncio.Queue[str]",
+        done: "asyncio.Queue[Tuple[str, List[Dict[str, Any]], Optional[str]]]",
+    ) -> None:
+        # A fila já vem cheia: o worker termina quando ela esvazia.
+        # Os workers limitam a concorrência por busca; o semáforo, entre buscas.
+        while True:
+            try:
+                item_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                async with self.semaphore:
+                    reviews, warning = await self._fetch_item_reviews(item_id)
+            except Exception as exc:
+                reviews, warning = [], f"erro inesperado ao buscar reviews ({item_id}): {exc}"
+            done.put_nowait((item_id, reviews, warning))
+
+    async def iter_reviews(
+        self, item_ids: List[str]
+    ) -> AsyncIterator[Tuple[str, List[Dict[str, Any]], Optional[str]]]:
+        """
+        Gera (item_id, lista_reviews, warning) à medida que cada item fica pronto:
+        primeiro os hits em memória, depois os do Redis, depois os fetches na ordem
+        em que terminam.
+        A API de reviews não tem multiget (só /items?ids= tem), então cada ID
+        distinto ainda custa uma requisição; IDs repetidos e hits do Redis não
+        saem para a rede.
+        """
+        unique_ids = list(dict.fromkeys(item_ids))
+
+        # Hits em memória saem antes do Redis e da fila: não ocupam worker nem semáforo
+        not_in_memory: List[str] = []
+        for item_id in unique_ids:
+            reviews = _reviews_cache.get(item_id)
+            if reviews is None:
+                not_in_memory.append(item_id)
+            else:
+                yield item_id, reviews, None
+
+        cached = await self._get_cached_reviews(not_in_memory)
+        for item_id, reviews in cached.items():
+            yield item_id, reviews, None
+
+        missing = [item_id for item_id in not_in_memory if item_id not in cached]
+        if not missing:
+            return
+
+        queue: "asyncio.Queue[str]" = asyncio.Queue()
+        for item_id in missing:
+            queue.put_nowait(item_id)
+
+        done: "asyncio.Queue[Tuple[str, List[Dict[str, Any]], Optional[str]]]" = asyncio.Queue()
+        workers = [
+            asyncio.ensure_future(self._reviews_worker(queue, done))
+            for _ in range(min(REVIEWS_CONCURRENCY, len(missing)))
+        ]
+
+        # Um review lento não segura o /search: após REVIEWS_TIMEOUT, o que faltou vira aviso
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + REVIEWS_TIMEOUT
+        pending = set(missing)
+        fresh: Dict[str, List[Dict[str, Any]]] = {}
+
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item_id, reviews, warning = await asyncio.wait_for(done.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+                pending.discard(item_id)
+                # Só o que veio do Mercado Livre volta ao Redis (hits não renovam TTL)
+                if warning is None:
+                    fresh[item_id] = reviews
+                yield item_id, reviews, warning
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        await self._store_cached_reviews(fresh)
+
+        for item_id in missing:
+            if item_id in pending:
+                yield item_id, [], f"timeout ao buscar reviews ({item_id})"
+
+    async def get_reviews_bulk(
+        self, item_ids: List[str]
+    ) -> Dict[str, Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Reviews de vários itens de uma vez: {item_id: (lista_reviews, warning)}.
+        """
+        results: Dict[str, Tuple[List[Dict[str, Any]], Optional[str]]] = {}
+        async for item_id, reviews, warning in self.iter_reviews(item_ids):
+            results[item_id] = (reviews, warning)
+        return results
 
     async def attach_reviews(
         self, items: List[Dict[str, Any]]
     ) -> Tuple[List[Dict[str, Any]], List[str]]:
-        tasks = [self._fetch_reviews_with_semaphore(item) for item in items]
-        results = await asyncio.gather(*tasks, return_exceptions=False)
+        """
+        Preenche item["reviews"] in place (os itens vêm de search_items e não são
+        reaproveitados) e devolve a mesma lista com os warnings.
+        """
+        item_ids = [str(item["id"]) for item in items if item.get("id")]
+        reviews_by_id = await self.get_reviews_bulk(item_ids)
 
-        items_with_reviews: List[Dict[str, Any]] = []
         warnings: List[str] = []
 
-        for item_with_reviews, warning in results:
-            items_with_reviews.append(item_with_reviews)
+        for item in items:
+            item_id = item.get("id")
+            if not item_id:
+                item["reviews"] = []
+                continue
+
+            reviews, warning = reviews_by_id[str(item_id)]
+            item["reviews"] = reviews or []
             if warning:
                 warnings.append(warning)
 
-        return items_with_reviews, warnings
+        return items, warnings
@@ -0,0 +1,48 @@
+"""
+Normalização do contrato de /search.
+
+Módulo isolado e totalmente anotado para poder ser compilado com mypyc
+(`mypyc normalize.py`) sem mudar nada no app; sem compilação roda como Python puro.
+"""
+
+from typing import Any, Dict, List, Optional
+
+_URL_SCHEMES = ("http://", "https://")
+
+
+def normalize_items(items: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Garante o contrato mínimo por item:
+      - title
+      - price
+      - image (URL ou None)
+      - permalink
+      - reviews (lista; pode ser vazia)
+    """
+    normalized: List[Dict[str, Any]] = []
+    append = normalized.append
+
+    for it in items or []:
+        get = it.get
+
+        # Garante que image seja URL (não thumbnail_id)
+        image = get("secure_thumbnail") or get("thumbnail") or get("image")
+        if not (isinstance(image, str) and image.startswith(_URL_SCHEMES)):
+            image = None
+
+        reviews = get("reviews")
+        if not isinstance(reviews, list):
+            reviews = []
+
+        append(
+            {
+                "id": get("id"),
+                "title": get("title") or get("name") or "",
+                "price": get("price"),
+                "image": image,
+                "permalink": get("permalink") or get("url") or None,
+                "reviews": reviews,
+            }
+        )
+
+    return normalized